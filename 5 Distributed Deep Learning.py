@@ -18,30 +18,72 @@ from utils.iot_setup import get_config
 config = get_config(spark, catalog='default')
 BATCH_SIZE = 2048
 EPOCHS = 20
+MIN_STEPS_PER_EPOCH = 100 # single-node GPU runs grow the batch size as far as this allows
+ACCUM = 8 # distributed runs only: batches to accumulate gradients over between optimizer steps, which cuts gradient syncs between processes by the same factor
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC DeltaTorch requires a unique id column, so we'll add that before we save to our target feature tables. For purposes of demonstration we'll also stick to simple numeric columns
+# MAGIC DeltaTorch requires an id column, which it uses to split rows between processes - the ids in each table need to run from 0 to the table's row count. We'll add that before we save to our target feature tables. For purposes of demonstration we'll also stick to simple numeric columns
 # MAGIC
 
 # COMMAND ----------
 
 # DBTITLE 1,Create Features
-from pyspark.sql import Window
-from pyspark.sql.functions import monotonically_increasing_id, row_number, col, lit
-
-bronze_df = spark.read.table(config['bronze_table'])
-categorical_cols = ['device_id', 'trip_id', 'timestamp', 'factory_id', 'model_id']
-training_df = bronze_df.drop(*categorical_cols).orderBy(col('timestamp'))
-training_df = training_df.withColumn('id', row_number().over(Window.orderBy(monotonically_increasing_id())))
-training_cols = training_df.drop('id').columns
-
-split_index = int(training_df.count() * 0.7) 
-train_df = training_df.where(col('id') <= split_index)
-test_df = training_df.where(col('id') > split_index)
-train_df.write.mode('overwrite').option('delta.enableDeletionVectors', 'false').format('delta').save(config['train_table'])
-test_df.write.mode('overwrite').option('delta.enableDeletionVectors', 'false').format('delta').save(config['test_table'])
+from pyspark.sql.functions import col, lit, create_map, monotonically_increasing_id, spark_partition_id, min as sql_min, max as sql_max
+
+training_cols = ['airflow_rate', 'rotation_speed', 'air_pressure', 'temperature', 'delay', 'density', 'defect']
+feature_cols = [c for c in training_cols if c != 'defect']
+# Selecting the columns up front lets Spark skip the string columns when reading the Parquet files
+bronze_df = spark.read.table(config['bronze_table']).select(*training_cols, 'timestamp')
+# Range partitioning sorts each timestamp range in parallel instead of funneling every row through one partition
+training_df = bronze_df.repartitionByRange('timestamp').sortWithinPartitions('timestamp')
+training_df = training_df.withColumn('timestamp', col('timestamp').cast('long'))
+training_df = training_df.cache() # materialized by the split quantile below, then reused by the bounds and both writes
+
+split_time = training_df.approxQuantile('timestamp', [0.7], 0.001)[0]
+train_rows = training_df.where(col('timestamp') < split_time)
+test_rows = training_df.where(col('timestamp') >= split_time)
+
+# Min-max scale the features to [0, 1] once here rather than adjusting them on every training batch. The bounds
+# come from the training split only, and are logged as params on the training run so scoring can apply the same scaling
+bounds = train_rows.agg(*[sql_min(c).alias(f'{c}_min') for c in feature_cols], *[sql_max(c).alias(f'{c}_max') for c in feature_cols]).first()
+feature_bounds = bounds.asDict()
+
+def min_max_scale(c):
+    low, high = bounds[f'{c}_min'], bounds[f'{c}_max']
+    return ((col(c) - low) / ((high - low) or 1)).alias(c)
+
+def scale_features(df):
+    return df.select(*[min_max_scale(c) if c in feature_cols else col(c) for c in training_cols])
+
+def with_row_id(df):
+    # monotonically_increasing_id is the partition index << 33 plus the row's position in the partition. Rebasing
+    # each partition onto the number of rows before it numbers the rows in timestamp order from 0, which is the
+    # id range DeltaTorch shards on, without a shuffle or a round trip through Python
+    df = df.withColumn('partition', spark_partition_id()).withColumn('id', monotonically_increasing_id())
+    counts = dict(df.groupBy('partition').count().collect())
+    offsets, total = [], 0
+    for partition in sorted(counts):
+        offsets += [lit(partition), lit(total - (partition << 33)).cast('long')]
+        total += counts[partition]
+    return df.withColumn('id', col('id') + create_map(*offsets)[col('partition')]).drop('partition')
+
+train_df = with_row_id(scale_features(train_rows))
+test_df = with_row_id(scale_features(test_rows))
+
+def write_feature_table(df, path):
+    (df.write.mode('overwrite')
+     .option('delta.enableDeletionVectors', 'false') # not supported by DeltaTorch
+     .option('delta.targetFileSize', '134217728') # 128 MiB files keep DeltaTorch's per-file overhead low
+     .format('delta').save(path))
+    # DeltaTorch reads contiguous id ranges, so co-locate them within the files. This also sizes the files, so the
+    # write above skips optimizeWrite rather than shuffling the rows out of id order only for this to restore it
+    spark.sql(f"OPTIMIZE delta.`{path}` ZORDER BY (id)")
+
+write_feature_table(train_df, config['train_table'])
+write_feature_table(test_df, config['test_table'])
+training_df.unpersist()
 
 # COMMAND ----------
 
@@ -51,21 +93,55 @@ test_df.write.mode('overwrite').option('delta.enableDeletionVectors', 'false').f
 # COMMAND ----------
 
 # DBTITLE 1,Dataloader Definition
+import os
 import pytorch_lightning as pl
+import torch
 from deltatorch import create_pytorch_dataloader, FieldSpec
 
 class DeltaDataModule(pl.LightningDataModule):
-    def __init__(self, train_path, test_path):
+    def __init__(self, train_path, test_path, target_column='defect', batch_size=BATCH_SIZE):
         self.train_path = train_path 
         self.test_path = test_path 
+        self.target_column = target_column
+        self.batch_size = batch_size
+        self.feature_keys = [c for c in training_cols if c != target_column]
+        self._dataloaders = {}
         super().__init__()
 
-    def dataloader(self, path: str, batch_size=BATCH_SIZE):
+    def __getstate__(self):
+        # Cached dataloaders hold worker processes, so they're rebuilt wherever the module is unpickled
+        state = self.__dict__.copy()
+        state['_dataloaders'] = {}
+        return state
+
+    def collate(self, rows):
+        # Build one dense features tensor per batch so the training step doesn't have to stack columns. This is a plain
+        # tuple because worker processes pickle batches by reference, and classes defined in the notebook can't be
+        # found that way inside TorchDistributor's processes
+        features = torch.tensor([[row[key] for key in self.feature_keys] for row in rows], dtype=torch.float32)
+        target = torch.tensor([row[self.target_column] for row in rows], dtype=torch.float32)
+        return features, target
+
+    def dataloader(self, path: str):
+        # Built lazily so DeltaTorch sees the distributed process group when it shards the table,
+        # and rebuilt whenever self.batch_size changes
+        cached = self._dataloaders.get(path)
+        if cached is None or cached.batch_size != self.batch_size:
+            self._dataloaders[path] = self._create_dataloader(path, self.batch_size)
+        return self._dataloaders[path]
+
+    def _create_dataloader(self, path: str, batch_size: int):
         return create_pytorch_dataloader(
             path,
             id_field='id',
             fields = [FieldSpec(field) for field in training_cols],
             batch_size=batch_size,
+            collate_fn=self.collate,
+            # Decode Parquet and collate in background workers so reads overlap with training
+            num_workers=max(4, os.cpu_count() // 2),
+            prefetch_factor=4,
+            persistent_workers=True,
+            pin_memory=torch.cuda.is_available(),
         )
 
     def train_dataloader(self):
@@ -85,46 +161,32 @@ class DeltaDataModule(pl.LightningDataModule):
 # COMMAND ----------
 
 # DBTITLE 1,Model Definition
-import mlflow
-import os
-from torch.utils.data import DataLoader, TensorDataset
 from pyspark.ml.torch.distributor import TorchDistributor
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from pytorch_lightning.loggers import MLFlowLogger
-from pytorch_lightning.callbacks import EarlyStopping
 
 
 class Autoencoder(pl.LightningModule):
-    def __init__(self, input_size, target_column, hidden_size=64, latent_dim=32):
+    def __init__(self, input_size, hidden_size=64, latent_dim=32):
         super().__init__()
-        self.target_column = target_column
-        self.encoder = nn.Sequential(
-            nn.Linear(input_size, hidden_size),
-            nn.ReLU(),
-            nn.Linear(hidden_size, latent_dim),
-            nn.ReLU()
-        )
-        self.decoder = nn.Sequential(
-            nn.Linear(latent_dim, hidden_size),
-            nn.ReLU(),
-            nn.Linear(hidden_size, 1), # Predicting just one class
-            nn.Sigmoid()  # Ensure input features are scaled between 0 and 1
-        )
+        self.encoder_hidden = nn.Linear(input_size, hidden_size)
+        self.encoder_latent = nn.Linear(hidden_size, latent_dim)
+        self.decoder_hidden = nn.Linear(latent_dim, hidden_size)
+        self.decoder_output = nn.Linear(hidden_size, 1) # Predicting just one class, returned as a logit
 
     def forward(self, x):
-        encoded = self.encoder(x)
-        decoded = self.decoder(encoded)
-        return decoded
+        # ReLU in place on each linear output to avoid allocating a second activation tensor per layer
+        encoded = F.relu(self.encoder_hidden(x), inplace=True)
+        encoded = F.relu(self.encoder_latent(encoded), inplace=True)
+        decoded = F.relu(self.decoder_hidden(encoded), inplace=True)
+        return self.decoder_output(decoded)
 
     def training_step(self, batch, batch_idx):
-        target = batch[self.target_column].float()
-        features = torch.stack([batch[key] for key in batch.keys() if key != self.target_column], dim=1).float()
-        features = torch.clamp(features, 0, 1)
-        predictions = self(features).squeeze()        
-        loss = F.binary_cross_entropy(predictions, target)
-        self.log('train_loss', loss, on_step=True, on_epoch=True, logger=True)
+        features, target = batch
+        logits = self(features).squeeze(-1)
+        loss = F.binary_cross_entropy_with_logits(logits, target) # autocast-safe, unlike binary_cross_entropy
+        self.log('train_loss', loss, on_step=False, on_epoch=True, sync_dist=False, logger=True)
         return loss
 
     def configure_optimizers(self):
@@ -141,19 +203,52 @@ class Autoencoder(pl.LightningModule):
 db_host = dbutils.notebook.entry_point.getDbutils().notebook().getContext().extraContext().apply('api_url')
 db_token = dbutils.notebook.entry_point.getDbutils().notebook().getContext().apiToken().get()
 
-def train_model(dataloader, input_size, num_gpus=1, single_node=True):
+def train_model(dataloader, input_size, db_host, db_token, feature_bounds, batch_size=BATCH_SIZE, num_gpus=1, single_node=True):
+    # Credentials come in as arguments and libraries are imported here, so the function doesn't depend on driver-only dbutils or module state
+    import os
+    import mlflow
+    import torch
+    import pytorch_lightning as pl
+    from pytorch_lightning.loggers import MLFlowLogger
+    from pytorch_lightning.callbacks import EarlyStopping
+    from pytorch_lightning.strategies import DDPStrategy
+    from pytorch_lightning.utilities.compile import to_uncompiled
+
+    dataloader.batch_size = batch_size
     os.environ['DATABRICKS_HOST'] = db_host
     os.environ['DATABRICKS_TOKEN'] = db_token
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = Autoencoder(input_size, 'defect')
+    torch.set_float32_matmul_precision('high') # lets fp32 matmuls use TF32 on GPUs that support it
+    model = Autoencoder(input_size)
     model.to(device)
+    compiled = torch.compile(model, mode='max-autotune' if torch.cuda.is_available() else 'default')
     mlflow.autolog(disable=True)
-    mlflow.set_experiment(config['pl_experiment_path'])
-    logger = MLFlowLogger(experiment_name=config['pl_experiment_path'])
-    early_stopping = EarlyStopping(monitor='train_loss', patience=3, mode='min', log_rank_zero_only=True)
-    trainer = pl.Trainer(max_epochs=EPOCHS, logger=logger, callbacks=[early_stopping], default_root_dir=config['log_path'])
-    trainer.fit(model, dataloader)
-    return model
+    if int(os.environ.get('RANK', 0)) == 0:
+        # Only rank 0 talks to the tracking server, the other processes train without a logger
+        logger = MLFlowLogger(experiment_name=config['pl_experiment_path'])
+        logger.log_hyperparams(feature_bounds)
+    else:
+        logger = False
+    early_stopping = EarlyStopping(monitor='train_loss', patience=3, mode='min', check_on_train_epoch_end=True, log_rank_zero_only=True)
+    if torch.cuda.is_available():
+        precision = 'bf16-mixed' if torch.cuda.is_bf16_supported() else '16-mixed'
+    else:
+        precision = '32-true' # fp16 autocast isn't supported on CPU, and bf16 is only faster on CPUs with native support
+    if single_node:
+        strategy = 'auto'
+    else:
+        # Every parameter is used on every step, so skip the unused parameter search and let DDP treat the graph as static
+        strategy = DDPStrategy(find_unused_parameters=False, static_graph=True, gradient_as_bucket_view=True, bucket_cap_mb=25)
+    trainer = pl.Trainer(max_epochs=EPOCHS, precision=precision, accumulate_grad_batches=1 if single_node else ACCUM, strategy=strategy, logger=logger, callbacks=[early_stopping], default_root_dir=config['log_path'])
+    if single_node and torch.cuda.is_available():
+        # The model is too small for GPU memory to ever limit the batch size, so rather than searching for it, grow it
+        # to the largest doubling of batch_size that still leaves MIN_STEPS_PER_EPOCH steps per epoch
+        max_batch_size = len(dataloader.train_dataloader().dataset) // MIN_STEPS_PER_EPOCH
+        while dataloader.batch_size * 2 <= max_batch_size:
+            dataloader.batch_size *= 2
+    trainer.fit(compiled, dataloader)
+    # fit swaps the module's forward and step methods for dynamo-wrapped ones, so undo that before handing it back
+    return to_uncompiled(compiled)
 
 # COMMAND ----------
 
@@ -169,7 +264,7 @@ data_module = DeltaDataModule(config['train_table'], config['test_table'])
 # COMMAND ----------
 
 # DBTITLE 1,Single Node Run
-model = train_model(data_module, input_size)
+model = train_model(data_module, input_size, db_host, db_token, feature_bounds)
 
 # COMMAND ----------
 
@@ -180,7 +275,7 @@ model = train_model(data_module, input_size)
 
 # DBTITLE 1,Multi Node Run
 distributor = TorchDistributor(num_processes=2, local_mode=False, use_gpu=False)
-model = distributor.run(train_model, data_module, input_size)
+model = distributor.run(train_model, data_module, input_size, db_host, db_token, feature_bounds, batch_size=BATCH_SIZE, single_node=False)
 
 # COMMAND ----------
 